@@ -1,20 +1,18 @@
 import os
 import logging
-import traceback
 import asyncio
+from collections import OrderedDict
 from fastapi import FastAPI
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-# <--- 新增: 匯入新的 LLM 類別 ---
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_anthropic import ChatAnthropic
-
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from opensearchpy import AsyncOpenSearch, AsyncHttpConnection
+from opensearchpy import AsyncOpenSearch, AsyncHttpConnection, JSONSerializer, SerializationError
+import orjson
 
 # --- 基礎設定 ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # --- 從環境變數讀取配置 ---
 OPENSEARCH_URL = os.getenv("OPENSEARCH_URL", "https://wazuh.indexer:9200")
@@ -26,31 +24,71 @@ LLM_PROVIDER = os.getenv("LLM_PROVIDER", "anthropic").lower() # 預設為 anthro
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 
+# 分析結果快取的最大筆數，設為 0 可停用快取
+TRIAGE_CACHE_SIZE = int(os.getenv("TRIAGE_CACHE_SIZE", "256"))
+# 單次 LLM 分析的逾時秒數，避免供應商無回應時卡住整個排程；
+# 需小於排程間隔 (60 秒)，否則逾時的批次仍會讓下一次排程被略過
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "45"))
+
 
 # --- OpenSearch 客戶端 ---
+class OrjsonSerializer(JSONSerializer):
+    """以 orjson 處理 OpenSearch 請求與回應的 JSON (搜尋結果、更新內容)"""
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return data
+        try:
+            # opensearch-py 的 bulk 會以 "\n" 串接各行，因此需回傳 str
+            return orjson.dumps(data, default=self.default).decode()
+        except TypeError as e:
+            raise SerializationError(data, e)
+
 client = AsyncOpenSearch(
     hosts=[OPENSEARCH_URL],
     http_auth=(OPENSEARCH_USER, OPENSEARCH_PASSWORD),
     use_ssl=True,
     verify_certs=False,
     ssl_show_warn=False,
-    connection_class=AsyncHttpConnection
+    connection_class=AsyncHttpConnection,
+    serializer=OrjsonSerializer()
 )
 
+# --- 查詢條件 (模組層級常數，避免每次排程重建) ---
+# 搜尋時只取回下列欄位，避免傳輸 full_log、data 等大型欄位。
+# 注意：未列出的欄位在 alert['_source'] 中不存在，讀取時只會得到 None 而不會報錯；
+# 擴充的分析函式若需讀取其他欄位 (例如 rule.id、srcip)，必須先加入此清單。
+ALERT_SOURCE_FIELDS = ["rule.description", "rule.level", "agent.name", "timestamp"]
+
+# 尚未含有 ai_analysis 欄位的警報即為待分析警報
+NEW_ALERTS_QUERY = {
+    "query": {"bool": {"must_not": [{"exists": {"field": "ai_analysis"}}]}},
+    "_source": ALERT_SOURCE_FIELDS,
+}
+
 # <--- 新增: 根據環境變數選擇 LLM 的函式 ---
 def get_llm():
     """根據環境變數 LLM_PROVIDER 選擇並初始化 LLM"""
-    logging.info(f"Selected LLM Provider: {LLM_PROVIDER}")
+    logger.info("Selected LLM Provider: %s", LLM_PROVIDER)
     
     if LLM_PROVIDER == 'gemini':
         if not GEMINI_API_KEY:
             raise ValueError("LLM_PROVIDER is 'gemini' but GEMINI_API_KEY is not set.")
+        # 僅匯入選定供應商的套件，縮短啟動時間
+        from langchain_google_genai import ChatGoogleGenerativeAI
         # Gemini 1.5 Flash 是速度和成本效益的絕佳選擇
         return ChatGoogleGenerativeAI(model="gemini-1.5-flash", google_api_key=GEMINI_API_KEY)
     
     elif LLM_PROVIDER == 'anthropic':
         if not ANTHROPIC_API_KEY:
             raise ValueError("LLM_PROVIDER is 'anthropic' but ANTHROPIC_API_KEY is not set.")
+        from langchain_anthropic import ChatAnthropic
         # Claude 3 Haiku 是最快、最經濟的 Claude 模型，非常適合入門
         return ChatAnthropic(model="claude-3-haiku-20240307", anthropic_api_key=ANTHROPIC_API_KEY)
         # 備選模型:
@@ -89,60 +127,117 @@ output_parser = StrOutputParser()
 chain = prompt_template | llm | output_parser
 
 
-# --- 核心工作函式 (維持不變) ---
+# --- 分析結果快取 ---
+# 同一規則在同一主機反覆觸發時，送進 LLM 的輸入完全相同，直接重用先前的分析。
+# 快取的是 Task 而非字串，讓同一批次中重複的警報也只會呼叫一次 LLM。
+triage_cache = OrderedDict()
+triage_cache_stats = {"hits": 0, "misses": 0}
+
+async def analyze_alert(alert_summary, context):
+    """以 (alert_summary, context) 為鍵執行 LLM 分析，命中快取時不再呼叫 LLM"""
+    key = (alert_summary, context)
+    task = triage_cache.get(key)
+    if task is None:
+        triage_cache_stats["misses"] += 1
+        task = asyncio.ensure_future(asyncio.wait_for(
+            chain.ainvoke({"alert_summary": alert_summary, "context": context}),
+            timeout=LLM_TIMEOUT_SECONDS,
+        ))
+        if TRIAGE_CACHE_SIZE > 0:
+            triage_cache[key] = task
+            if len(triage_cache) > TRIAGE_CACHE_SIZE:
+                triage_cache.popitem(last=False)
+    else:
+        triage_cache_stats["hits"] += 1
+        triage_cache.move_to_end(key)
+    try:
+        # shield: 單一呼叫端被取消時，不影響共用同一個 Task 的其他警報
+        return await asyncio.shield(task)
+    except Exception:
+        # 失敗 (含逾時) 的結果不保留，下次排程會重新分析
+        if triage_cache.get(key) is task:
+            del triage_cache[key]
+        raise
+
+# --- 核心工作函式 ---
+async def process_alert(alert):
+    """分析單一警報並回傳 ai_analysis 內容；失敗時回傳 None，不會中斷同批次的其他警報"""
+    alert_id = alert['_id']
+    try:
+        alert_source = alert['_source']
+        rule = alert_source.get('rule') or {}
+        agent = alert_source.get('agent') or {}
+        
+        alert_summary = f"Rule: {rule.get('description', 'N/A')} (Level: {rule.get('level', 'N/A')}) on Host: {agent.get('name', 'N/A')}"
+        logger.info("Found new alert to process: %s - %s", alert_id, alert_summary)
+
+        context = "No additional context retrieved for this example."
+        
+        analysis_result = await analyze_alert(alert_summary, context)
+        logger.debug("AI Analysis for %s: %s", alert_id, analysis_result)
+        
+        return {"triage_report": analysis_result, "provider": LLM_PROVIDER, "timestamp": alert_source.get('timestamp')}
+    except TimeoutError:
+        logger.error("LLM analysis timed out after %ss for alert %s; it will be retried on the next run.", LLM_TIMEOUT_SECONDS, alert_id)
+        return None
+    except Exception as e:
+        logger.error("An error occurred while processing alert %s: %s", alert_id, e, exc_info=True)
+        return None
+
 async def triage_new_alerts():
-    print("--- TRIAGE JOB EXECUTING NOW ---")
-    logging.info(f"Analyzing alerts with {LLM_PROVIDER} model...")
+    logger.info("Analyzing alerts with %s model...", LLM_PROVIDER)
     try:
-        response = await client.search(index="wazuh-alerts-*", body={"query":{"bool":{"must_not":[{"exists":{"field":"ai_analysis"}}]}}}, size=10)
+        response = await client.search(index="wazuh-alerts-*", body=NEW_ALERTS_QUERY, size=10)
         alerts = response['hits']['hits']
         if not alerts:
-            print("--- No new alerts found. ---")
-            logging.info("No new alerts found.")
+            logger.info("No new alerts found.")
             return
-        for alert in alerts:
-            alert_id = alert['_id']
-            alert_index = alert['_index']
-            alert_source = alert['_source']
-            rule = alert_source.get('rule', {})
-            agent = alert_source.get('agent', {})
-            
-            alert_summary = f"Rule: {rule.get('description', 'N/A')} (Level: {rule.get('level', 'N/A')}) on Host: {agent.get('name', 'N/A')}"
-            print(f"--- Found alert to process: {alert_id} ---")
-            logging.info(f"Found new alert to process: {alert_id} - {alert_summary}")
-
-            context = "No additional context retrieved for this example."
-            
-            analysis_result = await chain.ainvoke({"alert_summary": alert_summary, "context": context})
-            print(f"--- AI Analysis received: {analysis_result[:100]}... ---")
-            logging.info(f"AI Analysis for {alert_id}: {analysis_result}")
-            
-            update_body = {"doc": {"ai_analysis": {"triage_report": analysis_result, "provider": LLM_PROVIDER, "timestamp": alert_source.get('timestamp')}}}
-            await client.update(index=alert_index, id=alert_id, body=update_body)
-            print(f"--- Successfully updated alert {alert_id} ---")
-            logging.info(f"Successfully updated alert {alert_id} with AI analysis.")
+        # 各警報之間彼此獨立，同時送出 LLM 分析請求，總耗時約為最慢的一筆
+        analyses = await asyncio.gather(*(process_alert(alert) for alert in alerts))
+
+        # 以單一 _bulk 請求寫回所有分析結果，取代每筆警報各一次 update
+        actions = []
+        for alert, ai_analysis in zip(alerts, analyses):
+            if ai_analysis is None:
+                continue
+            actions.append({"update": {"_index": alert['_index'], "_id": alert['_id']}})
+            actions.append({"doc": {"ai_analysis": ai_analysis}})
+        if not actions:
+            return
+        result = await client.bulk(body=actions)
+        for item in result['items']:
+            update = item['update']
+            if 'error' in update:
+                logger.error("Failed to update alert %s: %s", update['_id'], update['error'])
+            else:
+                logger.info("Successfully updated alert %s with AI analysis.", update['_id'])
             
     except Exception as e:
-        print(f"!!!!!! A CRITICAL ERROR OCCURRED IN TRIAGE JOB !!!!!!")
-        logging.error(f"An error occurred during triage: {e}", exc_info=True)
-        traceback.print_exc()
+        logger.error("An error occurred during triage: %s", e, exc_info=True)
 
-# --- FastAPI 應用與排程 (維持不變) ---
+# --- FastAPI 應用與排程 ---
 app = FastAPI(title="Wazuh AI Triage Agent")
 scheduler = AsyncIOScheduler()
 
 @app.on_event("startup")
 async def startup_event():
-    logging.info("AI Agent starting up...")
+    logger.info("AI Agent starting up...")
     scheduler.add_job(triage_new_alerts, 'interval', seconds=60, id='triage_job', misfire_grace_time=30)
     scheduler.start()
-    logging.info("Scheduler started. Triage job scheduled.")
+    logger.info("Scheduler started. Triage job scheduled.")
 
 @app.get("/")
 def read_root():
-    return {"status": "AI Triage Agent is running", "scheduler_status": str(scheduler.get_jobs())}
+    return {
+        "status": "AI Triage Agent is running",
+        "scheduler_status": str(scheduler.get_jobs()),
+        "triage_cache": {"size": len(triage_cache), "max_size": TRIAGE_CACHE_SIZE, **triage_cache_stats},
+    }
 
 @app.on_event("shutdown")
-def shutdown_event():
+async def shutdown_event():
     scheduler.shutdown()
-    logging.info("Scheduler shut down.")
\ No newline at end of file
+    logger.info("Scheduler shut down.")
+    # 關閉共用的 OpenSearch 連線池 (aiohttp session)
+    await client.close()
+    logger.info("OpenSearch client closed.")
\ No newline at end of file